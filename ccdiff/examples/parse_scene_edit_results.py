@@ -48,6 +48,8 @@ COLLECT_SAVE_STAT_NAMES = ['all_sem_layer_rate_', 'all_comfort_', 'emd_']
 
 def parse_single_result(results_dir, eval_out_dir, save_hist_data=False, gt_hist_path=None):
     rjson = json.load(open(os.path.join(results_dir, "stats.json"), "r"))
+    # stats written with orjson store nan as null
+    rjson = {k: v if k == "scene_index" else np.array(v, dtype=np.float64).tolist() for k, v in rjson.items()}
     cfg = json.load(open(os.path.join(results_dir, "config.json"), "r"))
     print('eval_out_dir', eval_out_dir)
     # eval_out_dir = os.path.join(results_dir, 'eval_out')
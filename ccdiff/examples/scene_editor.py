@@ -6,19 +6,28 @@
 
 """A script for evaluating closed-loop simulation"""
 import argparse
-from symbol import star_expr
+import re
 import numpy as np
 import json
 import random
 import yaml
 import importlib
-from collections import Counter
+import multiprocessing
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from pathlib import Path
 from pprint import pprint
 import joblib
 
 import os
 import torch
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from tbsim.utils.batch_utils import set_global_batch_type
 from tbsim.utils.trajdata_utils import set_global_trajdata_batch_env, set_global_trajdata_batch_raster_cfg
 from tbsim.configs.scene_edit_config import SceneEditingConfig
@@ -31,24 +40,203 @@ from tbsim.policies.wrappers import (
     Pos2YawWrapper,
 )
 
-from tbsim.utils.tensor_utils import map_ndarray
+from tbsim.policies.common import Action, RolloutAction
 import tbsim.utils.tensor_utils as TensorUtils
 
-def read_txt(file_path): 
-    # Initialize an empty list to store the data
-    data = []
+# eval classes whose policies consume numpy observations
+_NO_TORCH_EVAL_CLASSES = frozenset({"GroundTruth", "GroundTruthOpenLoop", "GroundTruthNaN", "CCDiffHierarchicalPolicy", "ReplayAction"})
 
-    # Open the file and read line by line
+def _read_txt(file_path, mtime):
+    # rows may have different lengths, so keep one int array per line
+    data = []
     with open(file_path, 'r') as f:
         for line in f:
-            # Strip any extra whitespace and split the line into individual numbers
-            row = list(map(int, line.strip().split()))
-            # Append the row to the data list
-            data.append(row)
+            data.append(np.array(line.split(), dtype=np.int32))
     return data
 
+# _read_txt cached on disk across runs, only set up the first time a label file is read
+_READ_TXT_CACHED = None
+
+def read_txt(file_path): 
+    global _READ_TXT_CACHED
+    if _READ_TXT_CACHED is None:
+        _READ_TXT_CACHED = joblib.Memory(os.path.expanduser('~/.scene_editor_cache'), verbose=0).cache(_read_txt)
+    # the modification time is part of the cache key so edited files are re-parsed
+    file_path = os.path.abspath(file_path)
+    return _READ_TXT_CACHED(file_path, os.path.getmtime(file_path))
+
+# guide metric keys look like guide_<metric>_s<scene>g<guide>, grouped by the first 2 chars of the suffix
+_GUIDE_RE = re.compile(r'^(guide(?:_.*)?)_([^_]{0,2})[^_]*$')
+
+# whether skipping the env reset in _get_heuristic_cfg has been checked against a real reset
+_SKIPPED_RESET_CHECKED = False
+
+def _check_skipped_reset(env, scene_indices, start_frames, ex_obs):
+    '''
+    Debug check (run once) that the observation without the redundant reset matches the one after it.
+    '''
+    global _SKIPPED_RESET_CHECKED
+    if _SKIPPED_RESET_CHECKED:
+        return
+    _SKIPPED_RESET_CHECKED = True
+    curr_state = np.array(ex_obs['agents']['curr_agent_state'])
+    env.reset(scene_indices=scene_indices, start_frame_index=start_frames)
+    reset_state = np.array(env.get_observation()['agents']['curr_agent_state'])
+    assert np.array_equal(curr_state, reset_state, equal_nan=True), "skipping the env reset changed the example batch"
+
+def _get_heuristic_cfg(env, heuristic_config, scene_indices, sim_scene_indices, sim_start_frames, obs_to_torch,
+                       skip_reset=False, debug=False):
+    '''
+    Returns the heuristic guidance configs for the given sims. skip_reset indicates the env
+    is already reset to these scenes and start frames.
+    '''
+    # reset so that we can get an example batch to initialize guidance more efficiently
+    if not skip_reset:
+        env.reset(scene_indices=scene_indices, start_frame_index=sim_start_frames)
+    ex_obs = env.get_observation()
+    if skip_reset and debug:
+        _check_skipped_reset(env, scene_indices, sim_start_frames, ex_obs)
+    if obs_to_torch:
+        # heuristics only read agent_from_world from the example batch and move it straight back
+        #       to numpy, so it is wrapped as a CPU tensor instead of copying the batch to the device
+        ex_agents = dict(ex_obs['agents'])
+        ex_agents['agent_from_world'] = torch.from_numpy(ex_agents['agent_from_world'])
+        ex_obs = dict(ex_obs, agents=ex_agents)
+
+    # build heuristic guidance configs for these scenes
+    heuristic_guidance_cfg = compute_heuristic_guidance(heuristic_config,
+                                                        env,
+                                                        sim_scene_indices,
+                                                        sim_start_frames,
+                                                        example_batch=ex_obs['agents'])
+    return heuristic_guidance_cfg
+
+def _integer_linspace(a, b, n):
+    '''
+    Same as np.linspace(a, b, num=n, dtype=int).tolist(), staying in integers when the points are evenly spaced.
+    '''
+    if n <= 1:
+        return np.linspace(a, b, num=n, dtype=int).tolist()
+    span = b - a
+    if span > 0 and span % (n - 1) == 0:
+        return np.arange(a, b + 1, span // (n - 1), dtype=np.int64).tolist()
+    return np.linspace(a, b, num=n, dtype=int).tolist()
+
+# stats.json is rewritten after this many evaluated batches (and once at the end)
+_STATS_DUMP_EVERY = 10
+
+def _materialize_stats(result_stats_chunks, scene_idx_chunks):
+    result_stats = {k: np.concatenate(v, axis=0) for k, v in result_stats_chunks.items()}
+    result_stats["scene_index"] = np.concatenate(scene_idx_chunks)
+    return result_stats
+
+def _ndarray_to_list(x):
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    raise TypeError("Object of type %s is not JSON serializable" % type(x).__name__)
+
+def _dump_json(obj, path):
+    '''
+    Writes obj to a json file with orjson if it is installed (numeric arrays are serialized
+    without going through lists, nan is written as null), otherwise with the json module.
+    '''
+    if orjson is not None:
+        with open(path, "wb") as fp:
+            fp.write(orjson.dumps(obj, default=_ndarray_to_list, option=orjson.OPT_SERIALIZE_NUMPY))
+    else:
+        with open(path, "w+") as fp:
+            json.dump(obj, fp, default=_ndarray_to_list)
+
+def _dump_stats(results_dir, result_stats_chunks, scene_idx_chunks):
+    _dump_json(_materialize_stats(result_stats_chunks, scene_idx_chunks), os.path.join(results_dir, "stats.json"))
+
+class _EnvResetPrefetcher(object):
+    """Resets the env to the next batch of scenes on a background thread"""
+
+    def __init__(self, env):
+        self.env = env
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+    def submit(self, scene_indices, start_frame_index=None):
+        self.future = self.pool.submit(self.env.reset, scene_indices=scene_indices, start_frame_index=start_frame_index)
+
+    def has_pending(self):
+        return self.future is not None
+
+    def get(self):
+        future, self.future = self.future, None
+        return future.result()
+
+    def shutdown(self):
+        self.future = None
+        self.pool.shutdown(wait=True)
+
+def _compile_policy_nets(policy_model):
+    '''
+    Wraps the diffusion nets of the policy model with torch.compile. Methods like set_guidance_dim
+    are still reachable through the compiled module.
+    '''
+    policy_model.nets['policy'] = torch.compile(policy_model.nets['policy'], mode='reduce-overhead', fullgraph=False, dynamic=True)
+    # EMA weights are used for sampling instead when enabled
+    if getattr(policy_model, 'ema_policy', None) is not None:
+        policy_model.ema_policy = torch.compile(policy_model.ema_policy, mode='reduce-overhead', fullgraph=False, dynamic=True)
+
+def _to_float32(x):
+    return TensorUtils.recursive_dict_list_tuple_apply(
+        x,
+        {torch.Tensor: lambda t: t.float() if t.is_floating_point() else t},
+        ignore_if_unspecified=True
+    )
+
+class _AutocastRolloutWrapper(object):
+    """Queries the wrapped rollout policy under CUDA autocast and returns float32 actions"""
+
+    def __init__(self, rollout_policy, dtype):
+        self.rollout_policy = rollout_policy
+        self.dtype = dtype
+
+    def __getattr__(self, name):
+        return getattr(self.rollout_policy, name)
+
+    def get_action(self, obs, step_index):
+        with torch.autocast("cuda", dtype=self.dtype):
+            action = self.rollout_policy.get_action(obs, step_index=step_index)
+        # the env expects full precision actions
+        return RolloutAction(
+            ego=Action.from_dict(_to_float32(action.ego.to_dict())) if action.has_ego else None,
+            ego_info=_to_float32(action.ego_info),
+            agents=Action.from_dict(_to_float32(action.agents.to_dict())) if action.has_agents else None,
+            agents_info=_to_float32(action.agents_info),
+        )
+
+def _maybe_empty_cache(threshold_frac=0.9):
+    '''
+    Releases cached CUDA memory only when the device is nearly full, empty_cache synchronizes the device.
+    '''
+    if not torch.cuda.is_available():
+        return
+    free, total = torch.cuda.mem_get_info()
+    if (total - free) / total > threshold_frac:
+        torch.cuda.empty_cache()
+
+# rasterizer of a render worker process, built once by _init_render_worker
+_RENDER_RASTERIZER = None
+# each render worker loads its own trajdata rasterizer (dataset + maps), which bounds memory use
+_MAX_RENDER_WORKERS = 4
+
+def _init_render_worker(rasterizer_kwargs):
+    global _RENDER_RASTERIZER
+    from tbsim.utils.scene_edit_utils import get_trajdata_renderer
+    _RENDER_RASTERIZER = get_trajdata_renderer(**rasterizer_kwargs)
+
+def _render_scene(output_dir, si, scene_buffer, **kwargs):
+    from tbsim.utils.scene_edit_utils import visualize_guided_rollout
+    visualize_guided_rollout(output_dir, _RENDER_RASTERIZER, si, scene_buffer, **kwargs)
+
 def run_scene_editor(eval_cfg, save_cfg, data_to_disk, render_to_video, render_to_img, render_cfg, part_control=False, controllable_agent=-1, 
-                    human=False, rand_agent=False, num_steps_intervention=0):
+                    human=False, rand_agent=False, num_steps_intervention=0, debug=False, compile_policy=False,
+                    fast_math=False, autocast=False):
     assert eval_cfg.env in ["nusc", "trajdata"], "Currently only nusc and trajdata environments are supported"
         
     set_global_batch_type("trajdata")
@@ -65,20 +253,32 @@ def run_scene_editor(eval_cfg, save_cfg, data_to_disk, render_to_video, render_t
     random.seed(eval_cfg.seed)
     torch.manual_seed(eval_cfg.seed)
     torch.cuda.manual_seed(eval_cfg.seed)
+    if fast_math:
+        # TF32 matmuls/convs and cuDNN autotuning, results are no longer bitwise reproducible
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+        torch.set_float32_matmul_precision('high')
     # basic setup
     print('saving results to {}'.format(eval_cfg.results_dir))
     os.makedirs(eval_cfg.results_dir, exist_ok=True)
 
+    viz_dir = Path(eval_cfg.results_dir) / "viz"
+    matrix_dir = Path(eval_cfg.results_dir) / "matrix"
+    matrix_dir_created = False
     if render_to_video or render_to_img:
-        os.makedirs(os.path.join(eval_cfg.results_dir, "viz/"), exist_ok=True)
+        viz_dir.mkdir(parents=True, exist_ok=True)
     if save_cfg:
-        json.dump(eval_cfg, open(os.path.join(eval_cfg.results_dir, "config.json"), "w+"))
+        _dump_json(eval_cfg, os.path.join(eval_cfg.results_dir, "config.json"))
     if data_to_disk and os.path.exists(eval_cfg.experience_hdf5_path):
         os.remove(eval_cfg.experience_hdf5_path)
         pass
-    
 
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    # mixed precision for policy queries, bf16 where supported (Ampere and newer), fp16 otherwise
+    autocast_dtype = None
+    if autocast and device.type == "cuda":
+        autocast_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
     policy_composers = importlib.import_module("tbsim.evaluation.policy_composers")
     # create policy and rollout wrapper
     composer_class = getattr(policy_composers, eval_cfg.eval_class)
@@ -116,6 +316,13 @@ def run_scene_editor(eval_cfg, save_cfg, data_to_disk, render_to_video, render_t
             # print('set agent number to: ', controllable_agent)
             # policy_model.nets["policy"].reset_guidance()
             policy_model.set_diffusion_specific_params(eval_cfg.diffusion_specific_params)
+
+    # compile once here, the same nets are sampled at every step of every scene
+    # (control_policy has no nets of its own, it queries the same policy)
+    if compile_policy and not hasattr(torch, 'compile'):
+        print('torch.compile requires torch>=2.0, running the policy uncompiled')
+    elif compile_policy and torch.cuda.is_available() and hasattr(policy_model, 'nets') and 'policy' in policy_model.nets:
+        _compile_policy_nets(policy_model)
     # ----------------------------------------------------------------------------------
 
     # create env
@@ -126,7 +333,7 @@ def run_scene_editor(eval_cfg, save_cfg, data_to_disk, render_to_video, render_t
         raise NotImplementedError("{} is not a valid env".format(eval_cfg.env))
 
     # eval loop
-    obs_to_torch = eval_cfg.eval_class not in ["GroundTruth", "GroundTruthOpenLoop", "GroundTruthNaN", "CCDiffHierarchicalPolicy" "ReplayAction"]
+    obs_to_torch = eval_cfg.eval_class not in _NO_TORCH_EVAL_CLASSES
 
     heuristic_config = None
     use_ui = False
@@ -142,286 +349,344 @@ def run_scene_editor(eval_cfg, save_cfg, data_to_disk, render_to_video, render_t
         else:
             heuristic_config = []
 
-    render_rasterizer = None
-    if render_to_video or render_to_img:
-        from tbsim.utils.scene_edit_utils import get_trajdata_renderer
-        # initialize rasterizer once for all scenes
-        render_rasterizer = get_trajdata_renderer(eval_cfg.trajdata_source_test,
-                                                  eval_cfg.trajdata_data_dirs,
-                                                  future_sec=eval_cfg.future_sec,
-                                                  history_sec=eval_cfg.history_sec,
-                                                  raster_size=render_cfg['size'],
-                                                  px_per_m=render_cfg['px_per_m'],
-                                                  rebuild_maps=False,
-                                                  cache_location='~/.unified_data_cache')
-
-    result_stats = None
-    scene_i = 0
-    eval_scenes = eval_cfg.eval_scenes
-    if part_control: 
-        controllable_idx_dict = joblib.load("data/10_control_idx_test_init.pkl")
-        scene_idx_mapping = joblib.load("data/0_scene_idx.pkl")
-        if human: 
-            controllable_idx_human = read_txt("data/0_human_label.txt")
-            print(controllable_idx_human)
-    while scene_i < eval_cfg.num_scenes_to_evaluate:
-        scene_indices = eval_scenes[scene_i: scene_i + eval_cfg.num_scenes_per_batch]
-        scene_i += eval_cfg.num_scenes_per_batch
-        # check to make sure all the scenes are valid at starting step
-        scenes_valid = env.reset(scene_indices=scene_indices, start_frame_index=None)
-        if part_control:
-            max_controllable_size = min(controllable_agent, env.current_num_agents)
+    # background workers and the experience file, cleaned up even if the eval fails part way
+    render_pool = None
+    render_futures = []
+    h5_file = None
+    dump_pool = None
+    dump_futures = deque()
+    env_prefetcher = None
+    io_pool = None
+    io_futures = []
+    num_batches_to_dump = 0
+    try:
+        if render_to_video or render_to_img:
+            # rendering is CPU bound and independent per scene, so scenes are rendered in worker
+            #       processes that each initialize the rasterizer once for all scenes
+            rasterizer_kwargs = dict(desired_data=eval_cfg.trajdata_source_test,
+                                     data_dirs=eval_cfg.trajdata_data_dirs,
+                                     future_sec=eval_cfg.future_sec,
+                                     history_sec=eval_cfg.history_sec,
+                                     raster_size=render_cfg['size'],
+                                     px_per_m=render_cfg['px_per_m'],
+                                     rebuild_maps=False,
+                                     cache_location='~/.unified_data_cache')
+            # spawn rather than fork, workers start while other threads (env reset, writes) and CUDA are live
+            render_pool = ProcessPoolExecutor(max_workers=min(eval_cfg.num_scenes_per_batch, os.cpu_count(), _MAX_RENDER_WORKERS),
+                                              mp_context=multiprocessing.get_context("spawn"),
+                                              initializer=_init_render_worker,
+                                              initargs=(rasterizer_kwargs,))
+
+        # per-batch stats are only concatenated when written to disk
+        result_stats_chunks = defaultdict(list)
+        scene_idx_chunks = []
+        scene_i = 0
+        eval_scenes = eval_cfg.eval_scenes
+        if part_control: 
+            controllable_idx_dict = joblib.load("data/10_control_idx_test_init.pkl")
+            scene_idx_mapping = joblib.load("data/0_scene_idx.pkl")
             if human: 
-                control_idx = controllable_idx_human[scene_indices[0]][:max_controllable_size]
-            elif rand_agent:
-                control_idx = [idx for idx in range(max_controllable_size)]
-            else:  # selected agents
-                control_idx = controllable_idx_dict[scene_idx_mapping[scene_indices[0]]][:max_controllable_size]
+                controllable_idx_human = read_txt("data/0_human_label.txt")
+                print(controllable_idx_human)
+        # start frames of each scene only depend on its length, compute them once per scene
+        start_frame_cache = {}
+        def get_start_frames(cur_scene, sc_idx):
+            if sc_idx not in start_frame_cache:
+                sframe = exp_config.algo.history_num_frames+1
+                # want to make sure there's GT for the full rollout
+                eframe = cur_scene.length_timesteps - eval_cfg.num_simulation_steps
+                start_frame_cache[sc_idx] = _integer_linspace(sframe, eframe, eval_cfg.num_sim_per_scene)
+            return start_frame_cache[sc_idx]
+
+        if data_to_disk:
+            import h5py
+            # keep the file open for the whole eval, buffers are written from a background thread
+            h5_file = h5py.File(eval_cfg.experience_hdf5_path, "a", libver="latest")
+            dump_pool = ThreadPoolExecutor(max_workers=1)
+        env_prefetcher = _EnvResetPrefetcher(env)
+        io_pool = ThreadPoolExecutor(max_workers=2)
+        while scene_i < eval_cfg.num_scenes_to_evaluate:
+            scene_indices = eval_scenes[scene_i: scene_i + eval_cfg.num_scenes_per_batch]
+            scene_i += eval_cfg.num_scenes_per_batch
+            # check to make sure all the scenes are valid at starting step
+            if env_prefetcher.has_pending():
+                # already reset to this batch while the previous one was being post-processed
+                scenes_valid = env_prefetcher.get()
+            else:
+                scenes_valid = env.reset(scene_indices=scene_indices, start_frame_index=None)
+            if part_control:
+                max_controllable_size = min(controllable_agent, env.current_num_agents)
+                if human: 
+                    control_idx = controllable_idx_human[scene_indices[0]][:max_controllable_size].tolist()
+                elif rand_agent:
+                    control_idx = [idx for idx in range(max_controllable_size)]
+                else:  # selected agents
+                    control_idx = controllable_idx_dict[scene_idx_mapping[scene_indices[0]]][:max_controllable_size]
             
-            if len(control_idx) < max_controllable_size: 
-                additional_idx = list(np.random.choice([i for i in range(env.current_num_agents) if i not in control_idx], 
-                                size=(max_controllable_size-len(control_idx))))
-                control_idx = control_idx + additional_idx
-
-            mark_agents = [(i, "*", "red") for i in control_idx]
-            control_policy.set_controllable_set(control_idx)
-            if eval_cfg.eval_class in ['CCDiff']:
-                policy_model.nets['policy'].set_guidance_dim(control_idx, eval_cfg.n_step_action)
-                print("set guidance dim: ", control_idx, 'timestep: ', eval_cfg.n_step_action)
+                if len(control_idx) < max_controllable_size: 
+                    candidate_idx = np.setdiff1d(np.arange(env.current_num_agents), np.asarray(control_idx, dtype=int))
+                    additional_idx = np.random.choice(candidate_idx, size=(max_controllable_size-len(control_idx)), replace=False).tolist()
+                    control_idx = list(control_idx) + additional_idx
+
+                mark_agents = list(zip(control_idx, repeat("*"), repeat("red")))
+                control_policy.set_controllable_set(control_idx)
+                if eval_cfg.eval_class in ['CCDiff']:
+                    policy_model.nets['policy'].set_guidance_dim(control_idx, eval_cfg.n_step_action)
+                    print("set guidance dim: ", control_idx, 'timestep: ', eval_cfg.n_step_action)
+                else: 
+                    policy_model.nets['policy'].set_guidance_dim(control_idx)
+                    print("set guidance dim: ", control_idx,)
+
             else: 
-                policy_model.nets['policy'].set_guidance_dim(control_idx)
-                print("set guidance dim: ", control_idx,)
-
-        else: 
-            mark_agents = []
-        scene_indices = [si for si, sval in zip(scene_indices, scenes_valid) if sval]
-        if len(scene_indices) == 0:
-            print('no valid scenes in this batch, skipping...')
-            torch.cuda.empty_cache()
-            continue
+                mark_agents = []
+            scene_indices = np.asarray(scene_indices)[np.asarray(scenes_valid, dtype=bool)].tolist()
+            if len(scene_indices) == 0:
+                print('no valid scenes in this batch, skipping...')
+                continue
         
 
-        # if requested, split each scene up into multiple simulations
-        start_frame_index = [[exp_config.algo.history_num_frames+1]] * len(scene_indices)
-        if eval_cfg.num_sim_per_scene > 1:
-            start_frame_index = []
-            for si in range(len(scene_indices)):
-                cur_scene = env._current_scenes[si].scene
-                sframe = exp_config.algo.history_num_frames+1
-                # want to make sure there's GT for the full rollout
-                eframe = cur_scene.length_timesteps - eval_cfg.num_simulation_steps
-                scene_frame_inds = np.linspace(sframe, eframe, num=eval_cfg.num_sim_per_scene, dtype=int).tolist()
-                start_frame_index.append(scene_frame_inds)
-
-        # how many sims to run for the current batch of scenes
-        print('Starting frames in current scenes:', start_frame_index)
-        for ei in range(eval_cfg.num_sim_per_scene):
-            guidance_config = None   # for the current batch of scenes
-            constraint_config = None # for the current batch of scenes
+            # if requested, split each scene up into multiple simulations
+            start_frame_index = [[exp_config.algo.history_num_frames+1]] * len(scene_indices)
+            if eval_cfg.num_sim_per_scene > 1:
+                start_frame_index = [get_start_frames(env._current_scenes[si].scene, sc_idx) for si, sc_idx in enumerate(scene_indices)]
+
+            # how many sims to run for the current batch of scenes
+            print('Starting frames in current scenes:', start_frame_index)
+            for ei in range(eval_cfg.num_sim_per_scene):
+                guidance_config = None   # for the current batch of scenes
+                constraint_config = None # for the current batch of scenes
             
-            cur_start_frames = [scene_start[ei] for scene_start in start_frame_index]
-            # double check all scenes are valid at the current start step
-            scenes_valid = env.reset(scene_indices=scene_indices, start_frame_index=cur_start_frames)
-            sim_scene_indices = [si for si, sval in zip(scene_indices, scenes_valid) if sval]
-            sim_start_frames = [sframe for sframe, sval in zip(cur_start_frames, scenes_valid) if sval]
+                cur_start_frames = [scene_start[ei] for scene_start in start_frame_index]
+                # double check all scenes are valid at the current start step
+                scenes_valid = env.reset(scene_indices=scene_indices, start_frame_index=cur_start_frames)
+                valid_mask = np.asarray(scenes_valid, dtype=bool)
+                sim_scene_indices = np.asarray(scene_indices)[valid_mask].tolist()
+                sim_start_frames = np.asarray(cur_start_frames)[valid_mask].tolist()
+                if len(sim_scene_indices) == 0:
+                    continue
+
+                if not use_ui:
+                    # getting edits from either the config file or on-the-fly heuristics
+                    if "config" in eval_cfg.edits.editing_source:
+                        guidance_config = eval_cfg.edits.guidance_config
+                        constraint_config  = eval_cfg.edits.constraint_config
+                    if "heuristic" in eval_cfg.edits.editing_source:
+                        device = policy.device if device is None else device
+                        # the env was just reset with cur_start_frames, no need to do it again if nothing was filtered
+                        skip_reset = list(sim_start_frames) == list(cur_start_frames) and list(sim_scene_indices) == list(scene_indices)
+                        heuristic_guidance_cfg = _get_heuristic_cfg(env, heuristic_config, scene_indices,
+                                                                    sim_scene_indices, sim_start_frames,
+                                                                    obs_to_torch,
+                                                                    skip_reset=skip_reset, debug=debug)
+
+                        if len(heuristic_config) > 0:
+                            # we asked to apply some guidance, but if heuristic determined there was no valid
+                            #       guidance to apply (e.g. no social groups), we should skip these scenes.
+                            valid_scene_inds = []
+                            for sci, sc_cfg in enumerate(heuristic_guidance_cfg):
+                                if len(sc_cfg) > 0:
+                                    valid_scene_inds.append(sci)
+
+                            # collect only valid scenes under the given heuristic config
+                            heuristic_guidance_cfg = [heuristic_guidance_cfg[vi] for vi in valid_scene_inds]
+                            sim_scene_indices = [sim_scene_indices[vi] for vi in valid_scene_inds]
+                            sim_start_frames = [sim_start_frames[vi] for vi in valid_scene_inds]
+                            # skip if no valid...
+                            if len(sim_scene_indices) == 0:
+                                print('No scenes with valid heuristic configs in this sim, skipping...')
+                                continue
+
+                        # add to the current guidance config
+                        guidance_config = merge_guidance_configs(guidance_config, heuristic_guidance_cfg)
+                else:
+                    # TODO get guidance from the UI
+                    # TODO for UI, get edits from user. loop continuously until the user presses
+                    #       "play" or something like that then we roll out.
+                    raise NotImplementedError()
             if len(sim_scene_indices) == 0:
-                torch.cuda.empty_cache()
+                print('No scenes with valid heuristic configs in this scene, skipping...')
                 continue
 
-            if not use_ui:
-                # getting edits from either the config file or on-the-fly heuristics
-                if "config" in eval_cfg.edits.editing_source:
-                    guidance_config = eval_cfg.edits.guidance_config
-                    constraint_config  = eval_cfg.edits.constraint_config
-                if "heuristic" in eval_cfg.edits.editing_source:
-                    # reset so that we can get an example batch to initialize guidance more efficiently
-                    env.reset(scene_indices=scene_indices, start_frame_index=sim_start_frames)
-                    ex_obs = env.get_observation()
-                    if obs_to_torch:
-                        device = policy.device if device is None else device
-                        ex_obs = TensorUtils.to_torch(ex_obs, device=device, ignore_if_unspecified=True)
-
-                    # build heuristic guidance configs for these scenes
-                    heuristic_guidance_cfg = compute_heuristic_guidance(heuristic_config,
-                                                                        env,
-                                                                        sim_scene_indices,
-                                                                        sim_start_frames,
-                                                                        example_batch=ex_obs['agents'])
-                                                                        
-                    if len(heuristic_config) > 0:
-                        # we asked to apply some guidance, but if heuristic determined there was no valid
-                        #       guidance to apply (e.g. no social groups), we should skip these scenes.
-                        valid_scene_inds = []
-                        for sci, sc_cfg in enumerate(heuristic_guidance_cfg):
-                            if len(sc_cfg) > 0:
-                                valid_scene_inds.append(sci)
-
-                        # collect only valid scenes under the given heuristic config
-                        heuristic_guidance_cfg = [heuristic_guidance_cfg[vi] for vi in valid_scene_inds]
-                        sim_scene_indices = [sim_scene_indices[vi] for vi in valid_scene_inds]
-                        sim_start_frames = [sim_start_frames[vi] for vi in valid_scene_inds]
-                        # skip if no valid...
-                        if len(sim_scene_indices) == 0:
-                            print('No scenes with valid heuristic configs in this sim, skipping...')
-                            torch.cuda.empty_cache()
-                            continue
-
-                    # add to the current guidance config
-                    guidance_config = merge_guidance_configs(guidance_config, heuristic_guidance_cfg)
-            else:
-                # TODO get guidance from the UI
-                # TODO for UI, get edits from user. loop continuously until the user presses
-                #       "play" or something like that then we roll out.
-                raise NotImplementedError()
-        if len(sim_scene_indices) == 0:
-            print('No scenes with valid heuristic configs in this scene, skipping...')
-            torch.cuda.empty_cache()
-            continue
-
-        # remove agents from agent_collision guidance if they are in chosen gptcollision pair
-        for si in range(len(guidance_config)):
-            if len(guidance_config[si]) > 0:
-                agent_collision_heur_ind = None
-                gpt_collision_heur_ind = None
-                for i, cur_heur in enumerate(guidance_config[si]):
-                    if cur_heur['name'] == 'agent_collision':
-                        agent_collision_heur_ind = i
-                    elif cur_heur['name'] == 'gptcollision':
-                        gpt_collision_heur_ind = i
+            # remove agents from agent_collision guidance if they are in chosen gptcollision pair
+            for sc_cfg in guidance_config:
+                # last index of each guidance name in this scene
+                name_to_ind = {cur_heur['name']: i for i, cur_heur in enumerate(sc_cfg)}
+                agent_collision_heur_ind = name_to_ind.get('agent_collision')
+                gpt_collision_heur_ind = name_to_ind.get('gptcollision')
                 if agent_collision_heur_ind is not None and gpt_collision_heur_ind is not None:
-                        ind1 = guidance_config[si][gpt_collision_heur_ind]['params']['target_ind']
-                        ind2 = guidance_config[si][gpt_collision_heur_ind]['params']['ref_ind']
-                        excluded_agents = [ind1, ind2]
-                        guidance_config[si][agent_collision_heur_ind]['params']['excluded_agents'] = excluded_agents
-                        print('excluded_agents', excluded_agents)
-
-        # ----------------------------------------------------------------------------------
-        # Sampling Wrapper leveraging most existing policy composer sampling interfaces
-        from tbsim.policies.wrappers import NewSamplingPolicyWrapper
-        if eval_cfg.eval_class in ['TrafficSim', 'HierarchicalSampleNew']:
-            if scene_i == eval_cfg.num_scenes_per_batch or not isinstance(policy, NewSamplingPolicyWrapper):
-                policy = NewSamplingPolicyWrapper(policy, guidance_config)
-            else:
-                policy.update_guidance_config(guidance_config)
-        # ----------------------------------------------------------------------------------
-
-        if eval_cfg.policy.pos_to_yaw:
-            policy = Pos2YawWrapper(
-                policy,
-                dt=exp_config.algo.step_time,
-                yaw_correction_speed=eval_cfg.policy.yaw_correction_speed
-            )
-        # right now assume control of full scene
-        if part_control:
-            control_policy.add_policy(policy)
-            rollout_policy = RolloutWrapper(agents_policy=control_policy)
-            # policy = RolloutWrapper(agents_policy=policy)
-        else: 
-            rollout_policy = RolloutWrapper(agents_policy=policy)
-        stats, info, renderings = guided_rollout(
-            env,
-            rollout_policy,
-            policy_model,
-            n_step_action=eval_cfg.n_step_action,
-            guidance_config=guidance_config,
-            constraint_config=constraint_config,
-            render=False, # render after the fact
-            scene_indices=scene_indices,
-            obs_to_torch=obs_to_torch,
-            horizon=eval_cfg.num_simulation_steps,
-            start_frames=sim_start_frames,
-            eval_class=eval_cfg.eval_class,
-            apply_guidance=eval_cfg.apply_guidance, 
-            num_steps_intervention=num_steps_intervention
-        )
-
-        print(info["scene_index"])
-        print(sim_start_frames)
-        pprint(stats)
-
-        # aggregate stats from the same class of guidance within each scene
-        #       this helps parse_scene_edit_results
-        guide_agg_dict = {}
-        pop_list = []
-        for k,v in stats.items():
-            if k.split('_')[0] == 'guide':
-                guide_name = '_'.join(k.split('_')[:-1])
-                guide_scene_tag = k.split('_')[-1][:2]
-                canon_name = guide_name + '_%sg0' % (guide_scene_tag)
-                if canon_name not in guide_agg_dict:
-                    guide_agg_dict[canon_name] = []
-                guide_agg_dict[canon_name].append(v)
-                # remove from stats
-                pop_list.append(k)
-        for k in pop_list:
-            stats.pop(k, None)
-        # average over all of the same guide stats in each scene
-        for k,v in guide_agg_dict.items():
-            scene_stats = np.stack(v, axis=0) # guide_per_scenes x num_scenes (all are nan except 1)
-            stats[k] = np.mean(scene_stats, axis=0)
-
-        # aggregate metrics stats
-        if result_stats is None:
-            result_stats = stats
-            result_stats["scene_index"] = np.array(info["scene_index"])
-        else:
-            for k in stats:
-                if k not in result_stats:
-                    result_stats[k] = stats[k]
+                    gpt_params = sc_cfg[gpt_collision_heur_ind]['params']
+                    excluded_agents = [gpt_params['target_ind'], gpt_params['ref_ind']]
+                    sc_cfg[agent_collision_heur_ind]['params']['excluded_agents'] = excluded_agents
+                    print('excluded_agents', excluded_agents)
+
+            # ----------------------------------------------------------------------------------
+            # Sampling Wrapper leveraging most existing policy composer sampling interfaces
+            from tbsim.policies.wrappers import NewSamplingPolicyWrapper
+            if eval_cfg.eval_class in ['TrafficSim', 'HierarchicalSampleNew']:
+                if scene_i == eval_cfg.num_scenes_per_batch or not isinstance(policy, NewSamplingPolicyWrapper):
+                    policy = NewSamplingPolicyWrapper(policy, guidance_config)
                 else:
-                    result_stats[k] = np.concatenate([result_stats[k], stats[k]], axis=0)
-            result_stats["scene_index"] = np.concatenate([result_stats["scene_index"], np.array(info["scene_index"])])
-
-        # write stats to disk
-        with open(os.path.join(eval_cfg.results_dir, "stats.json"), "w+") as fp:
-            stats_to_write = map_ndarray(result_stats, lambda x: x.tolist())
-            json.dump(stats_to_write, fp)
-        if "matrix_ttc" in info.keys() and "matrix_dist" in info.keys():
-            os.makedirs(os.path.join(eval_cfg.results_dir, "matrix"), exist_ok=True)
-            np.save(os.path.join(eval_cfg.results_dir, "matrix", "ttc_{}.npy".format(info["scene_index"])), info["matrix_ttc"])
-            np.save(os.path.join(eval_cfg.results_dir, "matrix", "dist_{}.npy".format(info["scene_index"])), info["matrix_dist"])
-
-        if render_to_video or render_to_img:
-            # high quality
-            from tbsim.utils.scene_edit_utils import visualize_guided_rollout
-            scene_cnt = 0
-            for si, scene_buffer in zip(info["scene_index"], info["buffer"]):
-                viz_dir = os.path.join(eval_cfg.results_dir, "viz/")
-                invalid_guidance = guidance_config is None or len(guidance_config) == 0
-                invalid_constraint = constraint_config is None or len(constraint_config) == 0
-                visualize_guided_rollout(viz_dir, render_rasterizer, si, scene_buffer,
-                                            guidance_config=None if invalid_guidance else guidance_config[scene_cnt],
-                                            constraint_config=None if invalid_constraint else constraint_config[scene_cnt],
-                                            fps=(1.0 / exp_config.algo.step_time),
-                                            n_step_action=eval_cfg.n_step_action,
-                                            viz_diffusion_steps=False,
-                                            first_frame_only=render_to_img,
-                                            sim_num=sim_start_frames[scene_cnt],
-                                            save_every_n_frames=render_cfg['save_every_n_frames'],
-                                            draw_mode=render_cfg['draw_mode'],
-                                            mark_agents=mark_agents)
-                scene_cnt += 1
-
-        if data_to_disk and "buffer" in info:
-            dump_episode_buffer(
-                info["buffer"],
-                info["scene_index"],
-                sim_start_frames,
-                h5_path=eval_cfg.experience_hdf5_path
+                    policy.update_guidance_config(guidance_config)
+            # ----------------------------------------------------------------------------------
+
+            if eval_cfg.policy.pos_to_yaw:
+                policy = Pos2YawWrapper(
+                    policy,
+                    dt=exp_config.algo.step_time,
+                    yaw_correction_speed=eval_cfg.policy.yaw_correction_speed
+                )
+            # right now assume control of full scene
+            if part_control:
+                control_policy.add_policy(policy)
+                rollout_policy = RolloutWrapper(agents_policy=control_policy)
+                # policy = RolloutWrapper(agents_policy=policy)
+            else: 
+                rollout_policy = RolloutWrapper(agents_policy=policy)
+            if autocast_dtype is not None:
+                rollout_policy = _AutocastRolloutWrapper(rollout_policy, autocast_dtype)
+            stats, info, renderings = guided_rollout(
+                env,
+                rollout_policy,
+                policy_model,
+                n_step_action=eval_cfg.n_step_action,
+                guidance_config=guidance_config,
+                constraint_config=constraint_config,
+                render=False, # render after the fact
+                scene_indices=scene_indices,
+                obs_to_torch=obs_to_torch,
+                horizon=eval_cfg.num_simulation_steps,
+                start_frames=sim_start_frames,
+                eval_class=eval_cfg.eval_class,
+                apply_guidance=eval_cfg.apply_guidance, 
+                num_steps_intervention=num_steps_intervention
             )
-        torch.cuda.empty_cache()
-
-
-def dump_episode_buffer(buffer, scene_index, start_frames, h5_path):
-    import h5py
-    h5_file = h5py.File(h5_path, "a")
-
+            # the env is not used again for this batch (reset swaps in a new logger and the rollout
+            #       metrics are already copied out), load the next one while this one is post-processed
+            if scene_i < eval_cfg.num_scenes_to_evaluate:
+                env_prefetcher.submit(eval_scenes[scene_i: scene_i + eval_cfg.num_scenes_per_batch])
+
+            print(info["scene_index"])
+            print(sim_start_frames)
+            pprint(stats)
+
+            # aggregate stats from the same class of guidance within each scene
+            #       this helps parse_scene_edit_results
+            guide_sums = {}
+            guide_counts = {}
+            pop_list = []
+            for k,v in stats.items():
+                m = _GUIDE_RE.match(k)
+                if m is not None:
+                    canon_name = '%s_%sg0' % (m.group(1), m.group(2))
+                    # accumulate in place, v is num_scenes (all are nan except 1)
+                    if canon_name in guide_sums:
+                        np.add(guide_sums[canon_name], v, out=guide_sums[canon_name])
+                        guide_counts[canon_name] += 1
+                    else:
+                        guide_sums[canon_name] = np.array(v, dtype=np.float64)
+                        guide_counts[canon_name] = 1
+                    # remove from stats
+                    pop_list.append(k)
+            for k in pop_list:
+                stats.pop(k, None)
+            # average over all of the same guide stats in each scene
+            for k, v in guide_sums.items():
+                stats[k] = v / guide_counts[k]
+
+            # aggregate metrics stats
+            for k, v in stats.items():
+                result_stats_chunks[k].append(np.asarray(v))
+            scene_idx_chunks.append(np.array(info["scene_index"]))
+
+            # write stats to disk
+            num_batches_to_dump += 1
+            if num_batches_to_dump >= _STATS_DUMP_EVERY:
+                _dump_stats(eval_cfg.results_dir, result_stats_chunks, scene_idx_chunks)
+                num_batches_to_dump = 0
+            if "matrix_ttc" in info.keys() and "matrix_dist" in info.keys():
+                if not matrix_dir_created:
+                    matrix_dir.mkdir(exist_ok=True)
+                    matrix_dir_created = True
+                # file names are what causal_ranker expects, the writes overlap with the next batch
+                io_futures.append(io_pool.submit(np.save, matrix_dir / "ttc_{}.npy".format(info["scene_index"]), info["matrix_ttc"]))
+                io_futures.append(io_pool.submit(np.save, matrix_dir / "dist_{}.npy".format(info["scene_index"]), info["matrix_dist"]))
+
+            if render_to_video or render_to_img:
+                # high quality
+                # renders of the previous batch overlap with this batch's rollout, wait for them here
+                for f in render_futures:
+                    f.result()
+                render_futures = []
+                scene_cnt = 0
+                for si, scene_buffer in zip(info["scene_index"], info["buffer"]):
+                    invalid_guidance = guidance_config is None or len(guidance_config) == 0
+                    invalid_constraint = constraint_config is None or len(constraint_config) == 0
+                    render_futures.append(render_pool.submit(_render_scene, str(viz_dir), si, scene_buffer,
+                                                guidance_config=None if invalid_guidance else guidance_config[scene_cnt],
+                                                constraint_config=None if invalid_constraint else constraint_config[scene_cnt],
+                                                fps=(1.0 / exp_config.algo.step_time),
+                                                n_step_action=eval_cfg.n_step_action,
+                                                viz_diffusion_steps=False,
+                                                first_frame_only=render_to_img,
+                                                sim_num=sim_start_frames[scene_cnt],
+                                                save_every_n_frames=render_cfg['save_every_n_frames'],
+                                                draw_mode=render_cfg['draw_mode'],
+                                                mark_agents=mark_agents))
+                    scene_cnt += 1
+
+            if data_to_disk and "buffer" in info:
+                # overlap the disk write with the next batch, at most 2 dumps in flight
+                if len(dump_futures) == 2:
+                    dump_futures.popleft().result()
+                dump_futures.append(dump_pool.submit(
+                    dump_episode_buffer,
+                    info["buffer"],
+                    info["scene_index"],
+                    list(sim_start_frames),
+                    h5_file=h5_file
+                ))
+            _maybe_empty_cache()
+
+        # surface errors of the background work still in flight
+        for f in render_futures:
+            f.result()
+        for f in io_futures:
+            f.result()
+        while len(dump_futures) > 0:
+            dump_futures.popleft().result()
+    finally:
+        try:
+            if num_batches_to_dump > 0:
+                _dump_stats(eval_cfg.results_dir, result_stats_chunks, scene_idx_chunks)
+        finally:
+            # released even if the stats cannot be written
+            if env_prefetcher is not None:
+                env_prefetcher.shutdown()
+            if render_pool is not None:
+                # shutdown(cancel_futures=...) needs python>=3.9, drop the renders that have not started
+                for f in render_futures:
+                    f.cancel()
+                render_pool.shutdown(wait=True)
+            # queued matrix and buffer writes are still flushed to disk
+            if io_pool is not None:
+                io_pool.shutdown(wait=True)
+            if dump_pool is not None:
+                dump_pool.shutdown(wait=True)
+            if h5_file is not None:
+                h5_file.close()
+
+
+def dump_episode_buffer(buffer, scene_index, start_frames, h5_file):
     for ei, si, scene_buffer in zip(start_frames, scene_index, buffer):
         for mk in scene_buffer:
             h5key = "/{}_{}/{}".format(si, ei, mk)
-            h5_file.create_dataset(h5key, data=scene_buffer[mk])
-    h5_file.close()
-    print("scene {} written to {}".format(scene_index, h5_path))
+            # scalar and empty datasets cannot be chunked
+            if np.ndim(scene_buffer[mk]) > 0 and np.size(scene_buffer[mk]) > 0:
+                h5_file.create_dataset(h5key, data=scene_buffer[mk], chunks=True, compression="lzf")
+            else:
+                h5_file.create_dataset(h5key, data=scene_buffer[mk])
+    h5_file.flush()
+    print("scene {} written to {}".format(scene_index, h5_file.filename))
 
 
 if __name__ == "__main__":
@@ -640,6 +905,34 @@ if __name__ == "__main__":
         help="Number of scenes to run concurrently (to accelerate eval)"
     )
 
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        default=False,
+        help="whether to run extra (slow) consistency checks"
+    )
+
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        default=False,
+        help="whether to torch.compile the diffusion policy before rollout"
+    )
+
+    parser.add_argument(
+        "--no_fast_math",
+        action="store_true",
+        default=False,
+        help="disable TF32 and cuDNN autotuning (e.g. to compare runs exactly)"
+    )
+
+    parser.add_argument(
+        "--autocast",
+        action="store_true",
+        default=False,
+        help="whether to run policy inference under mixed precision (bf16 or fp16) autocast"
+    )
+
     args = parser.parse_args()
 
     cfg = SceneEditingConfig(registered_name=args.registered_name)
@@ -738,5 +1031,9 @@ if __name__ == "__main__":
         controllable_agent=args.controllable_agent,
         human=args.human, 
         rand_agent=args.rand_agent, 
-        num_steps_intervention=args.num_steps_intervention
+        num_steps_intervention=args.num_steps_intervention,
+        debug=args.debug,
+        compile_policy=args.compile,
+        fast_math=not args.no_fast_math,
+        autocast=args.autocast
     )